@@ -3,19 +3,44 @@ Gradio App for EV Utility Function Calculator
 Deployed on Hugging Face Spaces
 """
 
+import asyncio
+import functools
 import gradio as gr
 import json
+import numpy as np
 import os
-from upstash_redis import Redis
-
-# Initialize Redis client
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Sequence
+from upstash_redis.asyncio import Redis
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Initialize async Redis client so lookups don't block the event loop.
+# The client keeps a single pooled httpx.AsyncClient, so every lookup reuses the
+# same keep-alive connection to Upstash. Keep it module-level and never rebuild
+# it per request, or each call pays a fresh TLS handshake.
 redis = Redis(
     url=os.getenv("UPSTASH_REDIS_REST_URL"),
     token=os.getenv("UPSTASH_REDIS_REST_TOKEN")
 )
 
-# Feature keys in order
-FEATURE_KEYS = ["price", "range", "efficiency", "acceleration", "fast_charge", "seat_count"]
+# Feature keys in order, each paired with the scaling applied before the dot product.
+# This is the single source for both; FEATURE_KEYS and SCALE are derived from it.
+_SCALED_KEYS = (
+    ("price", 1e-3),
+    ("range", 1e-2),
+    ("efficiency", 1e-1),
+    ("acceleration", 1.0),
+    ("fast_charge", 1e-2),
+    ("seat_count", 1.0),
+)
+FEATURE_KEYS = [key for key, _ in _SCALED_KEYS]
+SCALE = np.array([scale for _, scale in _SCALED_KEYS])
 
 # Default coefficients
 DEFAULT_COEFFS = {
@@ -28,53 +53,169 @@ DEFAULT_COEFFS = {
 }
 
 
-def get_user_coefficients(user_id: str) -> dict[str, float]:
-    """Fetch user coefficients from Redis."""
-    redis_key = f"params:{user_id}"
-    data_str = redis.get(redis_key)
+def _loads(data: str) -> Any:
+    """Parse JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
-    if data_str is None:
-        return DEFAULT_COEFFS
 
-    if isinstance(data_str, bytes):
-        data_str = data_str.decode('utf-8')
+def _dumps(obj: Any) -> str:
+    """Serialize to indented JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
 
-    data = json.loads(data_str) if isinstance(data_str, str) else data_str
-    return data.get("coeffs", DEFAULT_COEFFS)
 
+class _CoeffEntry(NamedTuple):
+    """Cached coefficients for one user, in the forms the handlers need."""
+    fetched_at: float
+    coeffs: Mapping[str, float]
+    weights: np.ndarray
+    weight_values: tuple[float, ...]
+    coeffs_used: dict[str, float]
+    is_default: bool
 
-def scale_features(car_features: dict[str, float]) -> list[float]:
-    """Scale car features."""
-    def get_val(key: str) -> float:
-        val = car_features.get(key)
-        if val is None:
-            return 0.0
-        return float(val)
 
-    scaled = [
-        get_val("price") / 1000,
-        get_val("range") / 100,
-        get_val("efficiency") / 10,
-        get_val("acceleration"),
-        get_val("fast_charge") / 100,
-        get_val("seat_count"),
-    ]
-    return scaled
+# LRU cache of user_id -> _CoeffEntry to avoid a Redis round-trip per call.
+# user_id is caller-supplied free text, so the cache is bounded.
+_COEFF_CACHE: OrderedDict[str, _CoeffEntry] = OrderedDict()
+_TTL = 30.0
+_MAX_CACHED_USERS = 256
 
 
-def calculate_utility_score(car_features: dict[str, float], coeffs: dict[str, float]) -> float:
-    """Calculate utility score."""
-    scaled_features = scale_features(car_features)
-    coeff_array = [coeffs[key] for key in FEATURE_KEYS]
-    utility = sum(f * c for f, c in zip(scaled_features, coeff_array))
+async def get_user_coefficients(user_id: str) -> Mapping[str, float]:
+    """Fetch user coefficients from Redis, cached for _TTL seconds."""
+    return (await _get_cache_entry(user_id)).coeffs
+
+
+async def _get_cache_entry(user_id: str) -> _CoeffEntry:
+    """Return the user's cache entry, refetching from Redis once it is older than _TTL."""
+    entry = _COEFF_CACHE.get(user_id)
+    if entry is not None and time.monotonic() - entry.fetched_at < _TTL:
+        _COEFF_CACHE.move_to_end(user_id)
+        return entry
+
+    redis_key = f"params:{user_id}"
+    data_str = await redis.get(redis_key)
+    return _store_cache_entry(user_id, data_str)
+
+
+async def get_user_coefficients_many(user_ids: list[str]) -> dict[str, Mapping[str, float]]:
+    """Fetch coefficients for several users, using one MGET for any not already cached.
+
+    A user whose saved record cannot be parsed falls back to DEFAULT_COEFFS
+    instead of failing the whole batch.
+    """
+    now = time.monotonic()
+    found: dict[str, Mapping[str, float]] = {}
+    stale = []
+    for user_id in dict.fromkeys(user_ids):
+        entry = _COEFF_CACHE.get(user_id)
+        if entry is not None and now - entry.fetched_at < _TTL:
+            _COEFF_CACHE.move_to_end(user_id)
+            found[user_id] = entry.coeffs
+        else:
+            stale.append(user_id)
+
+    if stale:
+        values = await redis.mget(*[f"params:{user_id}" for user_id in stale])
+        for user_id, data_str in zip(stale, values):
+            # Use the returned entries: a large batch may evict its own earlier users
+            try:
+                entry = _store_cache_entry(user_id, data_str)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                entry = _store_cache_entry(user_id, None)
+            found[user_id] = entry.coeffs
+
+    return {user_id: found[user_id] for user_id in user_ids}
+
+
+def _store_cache_entry(user_id: str, data_str: Any) -> _CoeffEntry:
+    """Parse a raw Redis value (None if the key is missing) and cache it for user_id."""
+    if data_str is None:
+        coeffs = DEFAULT_COEFFS
+    else:
+        if isinstance(data_str, bytes):
+            data_str = data_str.decode('utf-8')
+
+        data = _loads(data_str) if isinstance(data_str, str) else data_str
+        coeffs = data.get("coeffs", DEFAULT_COEFFS)
+
+    weights = _scaled_weights(coeffs)
+    weights.flags.writeable = False
+
+    # Rounded once here rather than on every response
+    coeffs_used = {k: round(v, 4) for k, v in coeffs.items()}
+
+    entry = _CoeffEntry(
+        time.monotonic(), MappingProxyType(dict(coeffs)), weights, tuple(weights.tolist()),
+        coeffs_used, coeffs is DEFAULT_COEFFS,
+    )
+    _COEFF_CACHE[user_id] = entry
+    _COEFF_CACHE.move_to_end(user_id)
+    if len(_COEFF_CACHE) > _MAX_CACHED_USERS:
+        _COEFF_CACHE.popitem(last=False)
+    return entry
+
+
+def invalidate(user_id: str) -> None:
+    """Drop a user's cached coefficients, e.g. after they are re-trained."""
+    _COEFF_CACHE.pop(user_id, None)
+
+
+def _scaled_weights(coeffs: Mapping[str, float]) -> np.ndarray:
+    """Fold the feature scaling into the coefficients, in FEATURE_KEYS order."""
+    return SCALE * np.array([coeffs[key] for key in FEATURE_KEYS], dtype=np.float64)
+
+
+def _feature_matrix(cars: Sequence[Mapping[str, Any]]) -> np.ndarray:
+    """Lay out car features feature-major, shape (6, N), one contiguous row per feature."""
+    return np.stack([
+        np.fromiter((car.get(key) or 0.0 for car in cars), dtype=np.float64, count=len(cars))
+        for key in FEATURE_KEYS
+    ])
+
+
+def _score(weights: np.ndarray, feats: np.ndarray) -> np.ndarray:
+    """Dot the pre-scaled weights with a (6, N) feature matrix.
+
+    Accumulates one feature row at a time in a fixed order, so a car gets
+    bit-identical utility whether it is scored alone or within a list.
+    """
+    utilities = weights[0] * feats[0]
+    for weight, row in zip(weights[1:], feats[1:]):
+        utilities += weight * row
+    return utilities
+
+
+def _score_car(car_features: Mapping[str, Any], weights: Sequence[float]) -> float:
+    """Score a single car in plain floats.
+
+    Multiplies and accumulates in the same order as _score, so the result
+    matches scoring the car within a list bit for bit. Unrolled over
+    _SCALED_KEYS; the weights already carry the per-feature scaling.
+    """
+    get = car_features.get
+    utility = weights[0] * (get("price") or 0.0)
+    utility += weights[1] * (get("range") or 0.0)
+    utility += weights[2] * (get("efficiency") or 0.0)
+    utility += weights[3] * (get("acceleration") or 0.0)
+    utility += weights[4] * (get("fast_charge") or 0.0)
+    utility += weights[5] * (get("seat_count") or 0.0)
     return utility
 
 
-def calculate_single_utility(user_id: str, price: float, range_km: float, efficiency: float,
-                            acceleration: float, fast_charge: float, seat_count: int) -> str:
+def calculate_utility_score(car_features: dict[str, float], coeffs: Mapping[str, float]) -> float:
+    """Calculate utility score."""
+    return _score_car(car_features, _scaled_weights(coeffs).tolist())
+
+
+async def calculate_single_utility(user_id: str, price: float, range_km: float, efficiency: float,
+                                  acceleration: float, fast_charge: float, seat_count: int) -> str:
     """Calculate utility for a single car."""
     try:
-        coeffs = get_user_coefficients(user_id)
+        entry = await _get_cache_entry(user_id)
 
         car_features = {
             "price": price,
@@ -85,88 +226,106 @@ def calculate_single_utility(user_id: str, price: float, range_km: float, effici
             "seat_count": seat_count
         }
 
-        utility = calculate_utility_score(car_features, coeffs)
+        # Only the Redis lookup needs the event loop; score and encode in a worker thread
+        return await asyncio.to_thread(_single_utility_result, user_id, entry, car_features)
+    except Exception as e:
+        return _dumps({"error": str(e)})
 
-        result = {
-            "user_id": user_id,
-            "utility_score": round(utility, 4),
-            "coefficients_used": {k: round(v, 4) for k, v in coeffs.items()},
-            "car_features": car_features,
-            "note": "Using default coefficients" if coeffs == DEFAULT_COEFFS else "Using saved user preferences"
-        }
 
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({"error": str(e)}, indent=2)
+def _single_utility_result(user_id: str, entry: _CoeffEntry, car_features: dict[str, float]) -> str:
+    """Score one car and encode the response."""
+    utility = _score_car(car_features, entry.weight_values)
 
+    result = {
+        "user_id": user_id,
+        "utility_score": round(utility, 4),
+        "coefficients_used": entry.coeffs_used,
+        "car_features": car_features,
+        "note": "Using default coefficients" if entry.is_default else "Using saved user preferences"
+    }
+
+    return _dumps(result)
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_cars(cars_json: str) -> tuple[tuple[Mapping[str, Any], ...], np.ndarray]:
+    """Parse a cars JSON payload into read-only cars and their feature matrix, cached per payload."""
+    cars = tuple(MappingProxyType(car) for car in _loads(cars_json))
 
-def find_best_from_list(user_id: str, cars_json: str) -> str:
+    feats = _feature_matrix(cars)
+    feats.flags.writeable = False
+    return cars, feats
+
+
+async def find_best_from_list(user_id: str, cars_json: str) -> str:
     """Find the best car from a JSON list."""
     try:
-        cars = json.loads(cars_json)
-        coeffs = get_user_coefficients(user_id)
-
-        best_car = None
-        best_utility = float('-inf')
-        all_results = []
-
-        for car in cars:
-            utility = calculate_utility_score(car, coeffs)
-            car_result = {**car, "utility": round(utility, 4)}
-            all_results.append(car_result)
-
-            if utility > best_utility:
-                best_utility = utility
-                best_car = car_result
-
-        # Sort by utility descending
-        all_results.sort(key=lambda x: x["utility"], reverse=True)
-
-        result = {
-            "user_id": user_id,
-            "best_car": best_car,
-            "all_cars_ranked": all_results,
-            "coefficients_used": {k: round(v, 4) for k, v in coeffs.items()},
-            "note": "Using default coefficients" if coeffs == DEFAULT_COEFFS else "Using saved user preferences"
-        }
+        entry = await _get_cache_entry(user_id)
 
-        return json.dumps(result, indent=2)
+        # Parsing, scoring and encoding a large list would stall other sessions
+        # on the event loop, so only the Redis lookup runs here
+        return await asyncio.to_thread(_rank_cars, user_id, entry, cars_json)
     except json.JSONDecodeError:
-        return json.dumps({"error": "Invalid JSON format"}, indent=2)
+        return _dumps({"error": "Invalid JSON format"})
     except Exception as e:
-        return json.dumps({"error": str(e)}, indent=2)
+        return _dumps({"error": str(e)})
 
 
-# Example cars JSON
-example_cars = json.dumps([
-    {
-        "name": "Tesla Model 3",
-        "price": 45000,
-        "range": 500,
-        "efficiency": 150,
-        "acceleration": 6.1,
-        "fast_charge": 170,
-        "seat_count": 5
-    },
-    {
-        "name": "Volkswagen ID.4",
-        "price": 40000,
-        "range": 420,
-        "efficiency": 180,
-        "acceleration": 8.5,
-        "fast_charge": 125,
-        "seat_count": 5
-    },
-    {
-        "name": "Hyundai Ioniq 5",
-        "price": 48000,
-        "range": 480,
-        "efficiency": 165,
-        "acceleration": 7.4,
-        "fast_charge": 220,
-        "seat_count": 5
+def _rank_cars(user_id: str, entry: _CoeffEntry, cars_json: str) -> str:
+    """Parse, score and rank a JSON list of cars and encode the response."""
+    cars, feats = _parse_cars(cars_json)
+
+    # Score every car at once with the pre-scaled weights
+    utilities = _score(entry.weights, feats)
+    rounded = [round(utility, 4) for utility in utilities.tolist()]
+
+    # Rank by utility descending; the stable sort keeps the first car on ties.
+    # Parsed cars are shared through the cache, so results are fresh copies.
+    order = np.argsort(-utilities, kind="stable")
+    all_results = [{**cars[i], "utility": rounded[i]} for i in order]
+    best_car = all_results[0] if all_results else None
+
+    result = {
+        "user_id": user_id,
+        "best_car": best_car,
+        "all_cars_ranked": all_results,
+        "coefficients_used": entry.coeffs_used,
+        "note": "Using default coefficients" if entry.is_default else "Using saved user preferences"
     }
-], indent=2)
+
+    return _dumps(result)
+
+
+# Example cars JSON
+example_cars = """[
+  {
+    "name": "Tesla Model 3",
+    "price": 45000,
+    "range": 500,
+    "efficiency": 150,
+    "acceleration": 6.1,
+    "fast_charge": 170,
+    "seat_count": 5
+  },
+  {
+    "name": "Volkswagen ID.4",
+    "price": 40000,
+    "range": 420,
+    "efficiency": 180,
+    "acceleration": 8.5,
+    "fast_charge": 125,
+    "seat_count": 5
+  },
+  {
+    "name": "Hyundai Ioniq 5",
+    "price": 48000,
+    "range": 480,
+    "efficiency": 165,
+    "acceleration": 7.4,
+    "fast_charge": 220,
+    "seat_count": 5
+  }
+]"""
 
 
 # Create Gradio interface
@@ -8,26 +8,48 @@ using personalized coefficients stored in Upstash Redis.
 
 import json
 import os
-from typing import Any
+import time
+from collections import OrderedDict
+import numpy as np
+from types import MappingProxyType
+from typing import Any, Mapping, NamedTuple, Sequence
 from dotenv import load_dotenv
-from upstash_redis import Redis
+from upstash_redis.asyncio import Redis
 
 from mcp.server.models import InitializationOptions
 from mcp.server import NotificationOptions, Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
-# Initialize Redis client
+# Initialize async Redis client so lookups don't block the event loop.
+# The client keeps a single pooled httpx.AsyncClient, so every lookup reuses the
+# same keep-alive connection to Upstash. Keep it module-level and never rebuild
+# it per request, or each call pays a fresh TLS handshake.
 redis = Redis(
     url=os.getenv("UPSTASH_REDIS_REST_URL"),
     token=os.getenv("UPSTASH_REDIS_REST_TOKEN")
 )
 
-# Feature keys in order (must match the order in the coefficient array)
-FEATURE_KEYS = ["price", "range", "efficiency", "acceleration", "fast_charge", "seat_count"]
+# Feature keys in order, each paired with the training data scaling.
+# This is the single source for both; FEATURE_KEYS and SCALE are derived from it.
+_SCALED_KEYS = (
+    ("price", 1e-3),
+    ("range", 1e-2),
+    ("efficiency", 1e-1),
+    ("acceleration", 1.0),
+    ("fast_charge", 1e-2),
+    ("seat_count", 1.0),
+)
+FEATURE_KEYS = [key for key, _ in _SCALED_KEYS]
+SCALE = np.array([scale for _, scale in _SCALED_KEYS])
 
 # Default coefficients if user not found
 DEFAULT_COEFFS = {
@@ -40,58 +62,196 @@ DEFAULT_COEFFS = {
 }
 
 
-def get_user_coefficients(user_id: str) -> dict[str, float]:
+def _loads(data: str) -> Any:
+    """
+    Parse JSON, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(obj: Any) -> str:
+    """
+    Serialize to compact JSON, using orjson when it is installed.
+
+    MCP clients are programs, so responses skip pretty-printing.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+class _CoeffEntry(NamedTuple):
+    """
+    Cached coefficients for one user, in the forms the tool handlers need.
+    """
+    fetched_at: float
+    coeffs: Mapping[str, float]
+    weights: np.ndarray
+    weight_values: tuple[float, ...]
+    coeffs_used: dict[str, float]
+
+
+# LRU cache of user_id -> _CoeffEntry to avoid a Redis round-trip per call.
+# user_id is caller-supplied free text, so the cache is bounded.
+_COEFF_CACHE: OrderedDict[str, _CoeffEntry] = OrderedDict()
+_TTL = 30.0
+_MAX_CACHED_USERS = 256
+
+
+async def get_user_coefficients(user_id: str) -> Mapping[str, float]:
     """
     Fetch user coefficients from Redis. Returns default if not found.
+
+    Results are cached per user for _TTL seconds and returned read-only,
+    so repeated calls skip the Redis round-trip.
     """
+    return (await _get_cache_entry(user_id)).coeffs
+
+
+async def _get_cache_entry(user_id: str) -> _CoeffEntry:
+    """
+    Return the user's cache entry, refetching from Redis once it is older than _TTL.
+    """
+    entry = _COEFF_CACHE.get(user_id)
+    if entry is not None and time.monotonic() - entry.fetched_at < _TTL:
+        _COEFF_CACHE.move_to_end(user_id)
+        return entry
+
     redis_key = f"params:{user_id}"
-    data_str = redis.get(redis_key)
+    data_str = await redis.get(redis_key)
+    return _store_cache_entry(user_id, data_str)
+
+
+async def get_user_coefficients_many(user_ids: list[str]) -> dict[str, Mapping[str, float]]:
+    """
+    Fetch coefficients for several users, using one MGET for any not already cached.
 
+    A user whose saved record cannot be parsed falls back to DEFAULT_COEFFS
+    instead of failing the whole batch.
+    """
+    now = time.monotonic()
+    found: dict[str, Mapping[str, float]] = {}
+    stale = []
+    for user_id in dict.fromkeys(user_ids):
+        entry = _COEFF_CACHE.get(user_id)
+        if entry is not None and now - entry.fetched_at < _TTL:
+            _COEFF_CACHE.move_to_end(user_id)
+            found[user_id] = entry.coeffs
+        else:
+            stale.append(user_id)
+
+    if stale:
+        values = await redis.mget(*[f"params:{user_id}" for user_id in stale])
+        for user_id, data_str in zip(stale, values):
+            # Use the returned entries: a large batch may evict its own earlier users
+            try:
+                entry = _store_cache_entry(user_id, data_str)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                entry = _store_cache_entry(user_id, None)
+            found[user_id] = entry.coeffs
+
+    return {user_id: found[user_id] for user_id in user_ids}
+
+
+def _store_cache_entry(user_id: str, data_str: Any) -> _CoeffEntry:
+    """
+    Parse a raw Redis value (None if the key is missing) and cache it for user_id.
+    """
     if data_str is None:
-        return DEFAULT_COEFFS
+        coeffs = DEFAULT_COEFFS
+    else:
+        # Parse the JSON data - handle both string and bytes
+        if isinstance(data_str, bytes):
+            data_str = data_str.decode('utf-8')
 
-    # Parse the JSON data - handle both string and bytes
-    if isinstance(data_str, bytes):
-        data_str = data_str.decode('utf-8')
+        data = _loads(data_str) if isinstance(data_str, str) else data_str
+        coeffs = data.get("coeffs", DEFAULT_COEFFS)
 
-    data = json.loads(data_str) if isinstance(data_str, str) else data_str
-    return data.get("coeffs", DEFAULT_COEFFS)
+    weights = _scaled_weights(coeffs)
+    weights.flags.writeable = False
 
+    # Plain dict copy, ready to drop straight into responses
+    coeffs_used = dict(coeffs)
 
-def scale_features(car_features: dict[str, float]) -> list[float]:
+    entry = _CoeffEntry(
+        time.monotonic(), MappingProxyType(dict(coeffs)), weights, tuple(weights.tolist()), coeffs_used
+    )
+    _COEFF_CACHE[user_id] = entry
+    _COEFF_CACHE.move_to_end(user_id)
+    if len(_COEFF_CACHE) > _MAX_CACHED_USERS:
+        _COEFF_CACHE.popitem(last=False)
+    return entry
+
+
+def invalidate(user_id: str) -> None:
     """
-    Scale car features to match the training data scaling.
+    Drop a user's cached coefficients, e.g. after they are re-trained.
     """
-    def get_val(key: str) -> float:
-        val = car_features.get(key)
-        if val is None:
-            return 0.0
-        return float(val)
+    _COEFF_CACHE.pop(user_id, None)
 
-    # ORDER MATTERS: Must match FEATURE_KEYS
-    scaled = [
-        get_val("price") / 1000,
-        get_val("range") / 100,
-        get_val("efficiency") / 10,
-        get_val("acceleration"),
-        get_val("fast_charge") / 100,
-        get_val("seat_count"),
-    ]
-    return scaled
+
+def _scaled_weights(coeffs: Mapping[str, float]) -> np.ndarray:
+    """
+    Fold the feature scaling into the coefficients, in FEATURE_KEYS order.
+    """
+    return SCALE * np.array([coeffs[key] for key in FEATURE_KEYS], dtype=np.float64)
+
+
+def _feature_matrix(cars: Sequence[Mapping[str, Any]]) -> np.ndarray:
+    """
+    Lay out car features feature-major, shape (6, N), one contiguous row per feature.
+
+    Indexes features directly: only for cars that handle_call_tool has already
+    validated against the tool's inputSchema, which requires every feature.
+    """
+    return np.stack([
+        np.fromiter((car[key] for car in cars), dtype=np.float64, count=len(cars))
+        for key in FEATURE_KEYS
+    ])
 
 
-def calculate_utility_score(car_features: dict[str, float], coeffs: dict[str, float]) -> float:
+def _score(weights: np.ndarray, feats: np.ndarray) -> np.ndarray:
     """
-    Calculate utility score using dot product of features and coefficients.
+    Dot the pre-scaled weights with a (6, N) feature matrix.
+
+    Accumulates one feature row at a time in a fixed order, so a car gets
+    bit-identical utility whether it is scored alone or within a list.
     """
-    scaled_features = scale_features(car_features)
-    coeff_array = [coeffs[key] for key in FEATURE_KEYS]
+    utilities = weights[0] * feats[0]
+    for weight, row in zip(weights[1:], feats[1:]):
+        utilities += weight * row
+    return utilities
+
 
-    # Dot product
-    utility = sum(f * c for f, c in zip(scaled_features, coeff_array))
+def _score_car(car_features: Mapping[str, Any], weights: Sequence[float]) -> float:
+    """
+    Score a single car in plain floats.
+
+    Multiplies and accumulates in the same order as _score, so the result
+    matches scoring the car within a list bit for bit. Unrolled over
+    _SCALED_KEYS; the weights already carry the per-feature scaling.
+    """
+    get = car_features.get
+    utility = weights[0] * (get("price") or 0.0)
+    utility += weights[1] * (get("range") or 0.0)
+    utility += weights[2] * (get("efficiency") or 0.0)
+    utility += weights[3] * (get("acceleration") or 0.0)
+    utility += weights[4] * (get("fast_charge") or 0.0)
+    utility += weights[5] * (get("seat_count") or 0.0)
     return utility
 
 
+def calculate_utility_score(car_features: dict[str, float], coeffs: Mapping[str, float]) -> float:
+    """
+    Calculate utility score using dot product of scaled features and coefficients.
+
+    Input is not schema-validated here, so missing or null features score as 0.
+    """
+    return _score_car(car_features, _scaled_weights(coeffs).tolist())
+
+
 # Create the MCP server
 server = Server("utility-function")
 
@@ -174,16 +334,19 @@ async def handle_list_tools() -> list[Tool]:
     ]
 
 
-@server.call_tool()
+@server.call_tool(validate_input=True)
 async def handle_call_tool(name: str, arguments: dict[str, Any]) -> list[TextContent]:
     """
     Handle tool execution requests.
+
+    Arguments are validated against each tool's inputSchema before this runs,
+    so every car is known to carry all six numeric features.
     """
     if name == "calculate_utility":
         user_id = arguments["user_id"]
 
         # Get user coefficients
-        coeffs = get_user_coefficients(user_id)
+        entry = await _get_cache_entry(user_id)
 
         # Extract car features
         car_features = {
@@ -196,18 +359,18 @@ async def handle_call_tool(name: str, arguments: dict[str, Any]) -> list[TextCon
         }
 
         # Calculate utility
-        utility = calculate_utility_score(car_features, coeffs)
+        utility = _score_car(car_features, entry.weight_values)
 
         result = {
             "user_id": user_id,
             "utility": utility,
-            "coefficients_used": coeffs,
+            "coefficients_used": entry.coeffs_used,
             "car_features": car_features
         }
 
         return [TextContent(
             type="text",
-            text=json.dumps(result, indent=2)
+            text=_dumps(result)
         )]
 
     elif name == "find_best_car":
@@ -215,32 +378,28 @@ async def handle_call_tool(name: str, arguments: dict[str, Any]) -> list[TextCon
         cars = arguments["cars"]
 
         # Get user coefficients
-        coeffs = get_user_coefficients(user_id)
+        entry = await _get_cache_entry(user_id)
 
-        # Calculate utility for each car
-        best_car = None
-        best_utility = float('-inf')
-        all_results = []
+        # Calculate utility for every car at once with the pre-scaled weights
+        utilities = _score(entry.weights, _feature_matrix(cars))
 
-        for car in cars:
-            utility = calculate_utility_score(car, coeffs)
-            car_result = {**car, "utility": utility}
-            all_results.append(car_result)
+        # The request's car dicts are throwaway, so attach utilities in place
+        for car, utility in zip(cars, utilities.tolist()):
+            car["utility"] = utility
 
-            if utility > best_utility:
-                best_utility = utility
-                best_car = car_result
+        all_results = cars
+        best_car = cars[int(utilities.argmax())] if cars else None
 
         result = {
             "user_id": user_id,
             "best_car": best_car,
             "all_cars_with_utilities": all_results,
-            "coefficients_used": coeffs
+            "coefficients_used": entry.coeffs_used
         }
 
         return [TextContent(
             type="text",
-            text=json.dumps(result, indent=2)
+            text=_dumps(result)
         )]
 
     else:
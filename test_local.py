@@ -4,18 +4,20 @@ Simple test script to verify the utility calculation functions work correctly.
 This doesn't test the MCP protocol itself, just the core logic.
 """
 
+import asyncio
 import json
-from server import get_user_coefficients, calculate_utility_score
+import server
+from server import DEFAULT_COEFFS, get_user_coefficients, get_user_coefficients_many, calculate_utility_score
 
-def test_calculate_utility():
+async def test_calculate_utility():
     """Test basic utility calculation."""
     print("Testing utility calculation...")
 
     # Test with default coefficients
     user_id = "test_user_nonexistent"
-    coeffs = get_user_coefficients(user_id)
+    coeffs = await get_user_coefficients(user_id)
     print(f"\nCoefficients for {user_id}:")
-    print(json.dumps(coeffs, indent=2))
+    print(json.dumps(dict(coeffs), indent=2))
 
     # Example car features
     car = {
@@ -33,13 +35,13 @@ def test_calculate_utility():
     print(f"\nCalculated utility: {utility:.4f}")
 
 
-def test_with_saved_user():
+async def test_with_saved_user():
     """Test with a user that has saved preferences."""
     print("\n" + "="*60)
     print("Testing with saved user preferences...")
 
     user_id = "benjo"  # Should exist in Redis from the screenshot
-    coeffs = get_user_coefficients(user_id)
+    coeffs = await get_user_coefficients(user_id)
     print(f"\nCoefficients for {user_id}:")
     print(json.dumps({k: round(v, 4) for k, v in coeffs.items()}, indent=2))
 
@@ -86,10 +88,65 @@ def test_with_saved_user():
     print(f"\n🏆 Best car for {user_id}: {best_car} (utility: {best_utility:.4f})")
 
 
+class StubRedis:
+    """In-memory stand-in for the Upstash client that records MGET calls."""
+
+    def __init__(self, store):
+        self.store = store
+        self.mget_calls = []
+
+    async def mget(self, *keys):
+        self.mget_calls.append(keys)
+        return [self.store.get(key) for key in keys]
+
+
+async def test_coefficients_many():
+    """Test batched lookups against a stubbed Redis (no network needed)."""
+    print("\n" + "="*60)
+    print("Testing batched coefficient lookups...")
+
+    saved = {"price": -0.2, "range": 0.5, "efficiency": -0.1,
+             "acceleration": -0.3, "fast_charge": 0.2, "seat_count": 0.1}
+    stub = StubRedis({
+        "params:alice": json.dumps({"coeffs": saved}),
+        "params:broken": json.dumps({"coeffs": {"price": 1.0}}),  # missing features
+    })
+
+    real_redis = server.redis
+    server.redis = stub
+    server._COEFF_CACHE.clear()
+    try:
+        # Duplicate ids collapse into one key each, fetched in a single MGET
+        coeffs = await get_user_coefficients_many(["alice", "bob", "alice", "broken"])
+        assert list(coeffs) == ["alice", "bob", "broken"]
+        assert dict(coeffs["alice"]) == saved
+        assert dict(coeffs["bob"]) == DEFAULT_COEFFS
+        assert dict(coeffs["broken"]) == DEFAULT_COEFFS
+        assert stub.mget_calls == [("params:alice", "params:bob", "params:broken")]
+
+        # Users fetched within the TTL are served from the cache
+        await get_user_coefficients_many(["alice", "bob"])
+        assert len(stub.mget_calls) == 1
+
+        # A batch larger than the cache still returns every user
+        user_ids = [f"user{i}" for i in range(server._MAX_CACHED_USERS + 50)]
+        assert len(await get_user_coefficients_many(user_ids)) == len(user_ids)
+    finally:
+        server.redis = real_redis
+        server._COEFF_CACHE.clear()
+
+    print("Batched lookups OK")
+
+
+async def main():
+    await test_coefficients_many()
+    await test_calculate_utility()
+    await test_with_saved_user()
+
+
 if __name__ == "__main__":
     try:
-        test_calculate_utility()
-        test_with_saved_user()
+        asyncio.run(main())
         print("\n" + "="*60)
         print("✅ All tests completed successfully!")
     except Exception as e: